@@ -5,6 +5,7 @@ from setuptools import setup
 setup (name = 'ugit',
        version = '1.0',
        packages = ['ugit'],
+       python_requires = '>=3.9',
        entry_points = {
            'console_scripts' : [
                'ugit = ugit.cli:main'
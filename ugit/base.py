@@ -1,14 +1,19 @@
+import functools
 import itertools
 import operator
 import os
 from pickle import FALSE
-import string
 
 from collections import deque, namedtuple
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 
 from . import data
 from . import diff
 
+# shared by the sibling subtrees of `write_tree`
+_tree_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 def init():
     data.init()
     data.update_ref('HEAD', data.RefValue(symbolic=True, value='refs/heads/master'))
@@ -29,95 +34,182 @@ def write_tree():
                 current = current.setdefault(dirname, {})
             current[filename] = oid
 
-    def write_tree_recursive(tree_dict):
-        entries = []
-        for name, value in tree_dict.items():
+    def write_tree_recursive(tree_dict, depth=0):
+        # only the root fans out: a subtree task waiting on
+        # its own children could starve the shared pool
+        if depth == 0 and len(tree_dict) >= 4:
+            subtrees = {name: _tree_executor.submit(write_tree_recursive,
+                                                    value, depth + 1)
+                        for name, value in tree_dict.items()
+                        if type(value) is dict}
+        else:
+            subtrees = {}
+
+        # names are unique within a tree, so sorting them alone
+        # gives the same order as sorting whole entries
+        tree = bytearray()
+        for name in sorted(tree_dict):
+            value = tree_dict[name]
             if type(value) is dict:
                 type_ = 'tree'
-                oid = write_tree_recursive(value)
+                if name in subtrees:
+                    oid = subtrees[name].result()
+                else:
+                    oid = write_tree_recursive(value, depth + 1)
             else:
                 type_ = 'blob'
                 oid = value
-            entries.append((name, oid, type_))
+            tree += f'{type_} {oid} {name}\n'.encode()
 
-        tree = ''.join(f'{type_} {oid} {name}\n'
-                       for name, oid, type_
-                       in sorted (entries))
-        return data.hash_object(tree.encode(), 'tree')
+        return data.hash_object(tree, 'tree')
 
     return write_tree_recursive(index_as_tree)
 
+_BAD_NAMES = frozenset({'.', '..'})
+
+@functools.lru_cache(maxsize=2048)
 def _iter_tree_entries(oid):
     """
-    a generator that will take an OID of a tree,
-    tokenize it line-by-line and yield the raw string values
+    take an OID of a tree, tokenize it line-by-line and
+    return the raw string values. Trees are immutable so
+    the result is cached
     """
     if not oid:
-        return
+        return ()
+    entries = []
     tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split (' ', 2)
-        yield type_, oid, name
+    # only the name can be non-ASCII, so decode field by field
+    for entry in tree.splitlines():
+        type_, oid, name = entry.split(b' ', 2)
+        name = name.decode()
+        if name in _BAD_NAMES or '/' in name:
+            raise ValueError(f'{name} should not be . or .. or contain /')
+        entries.append((type_.decode(), oid.decode(), name))
+    return tuple(entries)
 
 def get_tree(oid, base_path=''):
     """
-    use `_iter_tree_entries` to recursively parse a
-    tree into a dict.
+    use `_iter_tree_entries` to parse a tree into a dict,
+    walking the subtrees with an explicit stack
     """
     result = {}
-    for type_, oid , name in _iter_tree_entries(oid):
-        if '/' in name:
-            raise ValueError(f'{name} should not contain /')
-        if name in ('..', '.'):
-            raise ValueError(f'{name} should not contain .. or .')
-        path = base_path + name
-        if type_ == 'blob':
-            result[path] = oid
-        elif type_ == 'tree':
-            result.update(get_tree(oid, f'{path}/'))
+    stack = [(iter(_iter_tree_entries(oid)), base_path)]
+    while stack:
+        entries, base_path = stack[-1]
+        for type_, oid , name in entries:
+            path = base_path + name
+            if type_ == 'blob':
+                result[path] = oid
+            elif type_ == 'tree':
+                # descend now so paths keep their sorted order
+                stack.append((iter(_iter_tree_entries(oid)), f'{path}/'))
+                break
+            else:
+                raise TypeError(f'Unknown tree entry {type_}')
         else:
-            raise TypeError(f'Unknown tree entry {type_}')
+            stack.pop()
     return result
 
+def compare_tree_oids(*tree_oids):
+    """
+    take a list of tree OIDs and return the paths which
+    differ between them, grouped by filename like
+    `diff.compare_trees`. Subtrees with the same OID in
+    every tree are skipped without being read
+    """
+    yield from _compare_tree_oids('', tree_oids)
+
+def _compare_tree_oids(base_path, tree_oids):
+    blobs = {}
+    subtrees = {}
+    for i, tree_oid in enumerate(tree_oids):
+        for type_, oid, name in _iter_tree_entries(tree_oid):
+            entries = subtrees if type_ == 'tree' else blobs
+            entry = entries.get(name)
+            if entry is None:
+                entry = entries[name] = [None] * len(tree_oids)
+            entry[i] = oid
+    for name in sorted(blobs.keys() | subtrees.keys()):
+        oids = blobs.get(name)
+        if oids and len(set(oids)) > 1:
+            yield (base_path + name, *oids)
+        oids = subtrees.get(name)
+        if oids and len(set(oids)) > 1:
+            yield from _compare_tree_oids(f'{base_path}{name}/', oids)
+
+# below this many files the process pool costs more than it saves
+_PARALLEL_HASH_THRESHOLD = 64
+
+def _iter_entries(root):
+    """
+    iteratively walk `root` and yield the path and the
+    `os.DirEntry` of everything which is not ignored
+    """
+    root = os.path.relpath(root)
+    if is_ignored(root):
+        return
+    pending = deque([root])
+    while pending:
+        dirpath = pending.popleft()
+        # dirpath is already relative, so the paths can be
+        # joined directly instead of calling relpath per entry
+        prefix = '' if dirpath == '.' else f'{dirpath}/'
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                # prune the whole subtree instead of testing each path
+                if entry.name == '.ugit':
+                    continue
+                path = prefix + entry.name
+                yield path, entry
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(path)
+
+def _collect_blob_paths(directory):
+    """
+    return a flat list of all the file paths under `directory`
+    """
+    # links to files are followed on purpose, like os.path.isfile
+    return [path for path, entry in _iter_entries(directory)
+            if entry.is_file()]
+
+def _init_hash_worker(git_dir):
+    data.GIT_DIR = git_dir
+
+def _hash_file(path):
+    return path, data.hash_object_stream(path)
+
+def _file_oid(path):
+    return path, data.compute_file_oid(path)
+
+def _hash_files(paths, store=True):
+    """
+    put all the files in the object database, or only hash
+    them when `store` is false, and return a dict that holds
+    their OIDs, hashing them in a pool of processes when
+    there are enough of them and more than one CPU to run
+    them on
+    """
+    hash_file = _hash_file if store else _file_oid
+    if (len(paths) < _PARALLEL_HASH_THRESHOLD
+            or (os.cpu_count() or 1) < 2):
+        return dict(map(hash_file, paths))
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             initializer=_init_hash_worker,
+                             initargs=(data.GIT_DIR,)) as executor:
+        return dict(executor.map(hash_file, paths, chunksize=32))
+
 def get_working_tree():
     """
     walk over all files in the working directory, put them
     in the object database and create a dict that holds all
     the OIDs
     """
-    result = {}
-    for root, _, filenames in os.walk('.'):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, 'rb') as f:
-                result[path] = data.hash_object(f.read())
-    return result
+    return _hash_files(_collect_blob_paths('.'))
 
 def get_index_tree():
     with data.get_index() as index:
         return index
 
-def _empty_current_directory():
-    """
-    Delete all existing stuff before reading
-    """
-    for root, dirnames, filenames in os.walk('.', topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(f'{root}/{dirname}')
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except(FileNotFoundError, OSError):
-                pass
-
 def read_tree(tree_oid, update_working=False):
     """
     use `get_tree` to get the file OIDs and writes them into
@@ -137,21 +229,64 @@ def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
     """
     with data.get_index() as index:
         index.clear()
-        index.update(diff.merge_trees(
-            get_tree(t_base),
+        # start from HEAD and only merge the paths which differ
+        index.update(diff.merge_entries(
             get_tree(t_HEAD),
-            get_tree(t_other)
+            compare_tree_oids(t_base, t_HEAD, t_other)
         ))
 
         if update_working:
             _checkout_index(index)
 
 def _checkout_index(index):
-    _empty_current_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(f'./{path}'), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(data.get_object(oid, 'blob'))
+    """
+    bring the working directory in line with the index,
+    only touching the files which differ from it
+    """
+    dirs = []
+    files = []
+    links = []
+    for path, entry in _iter_entries('.'):
+        if entry.is_symlink():
+            links.append(path)
+        elif entry.is_dir(follow_symlinks=False):
+            dirs.append(path)
+        elif entry.is_file():
+            files.append(path)
+    # never compare or write through a link, that would touch
+    # its target instead of the working tree
+    for path in links:
+        os.remove(path)
+    # untracked files are removed whatever they hold, so only
+    # the tracked ones need hashing, and without storing them
+    tracked = []
+    for path in files:
+        if path in index:
+            tracked.append(path)
+        else:
+            os.remove(path)
+    current = _hash_files(tracked, store=False)
+    # prune every empty directory, which also clears the ones
+    # standing where the index has a file. Children are always
+    # found after their parents
+    for path in reversed(dirs):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    to_write = {path: oid for path, oid in index.items()
+                if current.get(path) != oid}
+    # create each directory once, parents before children
+    for dirname in sorted({os.path.dirname(f'./{path}') for path in to_write}):
+        os.makedirs(dirname, exist_ok=True)
+    # reading the blobs is I/O bound, so overlap the reads
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(data.get_object, oid, 'blob'): path
+                   for path, oid in to_write.items()}
+        for future in as_completed(futures):
+            with open(futures[future], 'wb') as f:
+                f.write(future.result())
 
 def commit(message):
     """
@@ -210,11 +345,19 @@ def merge(other):
 
 def get_merge_base(oid1, oid2):
     """
-    receive two commit OIDs and find their common ancestor
+    receive two commit OIDs and find their common ancestor.
+    The ancestors of `oid1` are only walked as far as needed,
+    so the search stops early when the two histories meet
     """
-    parents1 = set(iter_commits_and_parents({oid1}))
+    parents1 = set()
+    ancestors1 = iter_commits_and_parents({oid1})
 
     for oid in iter_commits_and_parents({oid2}):
+        while oid not in parents1:
+            parent = next(ancestors1, None)
+            if parent is None:
+                break
+            parents1.add(parent)
         if oid in parents1:
             return oid
 
@@ -257,23 +400,25 @@ def get_branch_name():
 
 Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
 
+@functools.lru_cache(maxsize=4096)
 def get_commit(oid):
     """
-    Traverse commit object to achieve `ugit log`
+    Traverse commit object to achieve `ugit log`. Commits
+    are immutable so the result is cached
     """
     parents = []
-    commit = data.get_object(oid, 'commit').decode()
+    commit = data.get_object(oid, 'commit')
     lines = iter(commit.splitlines())
     for line in itertools.takewhile(operator.truth, lines):
-        key, value = line.split(' ', 1)
-        if key == 'tree':
-            tree = value
-        elif key == 'parent':
-            parents.append(value)
+        key, value = line.split(b' ', 1)
+        if key == b'tree':
+            tree = value.decode()
+        elif key == b'parent':
+            parents.append(value.decode())
         else:
-            raise TypeError(f'Unknown field {key}')
-    message = '\n'.join(lines)
-    return Commit(tree=tree, parents=parents, message=message)
+            raise TypeError(f'Unknown field {key.decode()}')
+    message = b'\n'.join(lines).decode()
+    return Commit(tree=tree, parents=tuple(parents), message=message)
 
 def iter_commits_and_parents(oids):
     """
@@ -301,62 +446,61 @@ def iter_objects_in_commits(oids):
     """
     visited = set()
     def iter_objects_in_tree(oid):
-        visited.add(oid)
-        yield oid
-        for type_, oid, _ in _iter_tree_entries(oid):
-            if oid not in visited:
+        trees = [oid]
+        while trees:
+            oid = trees.pop()
+            if oid in visited:
+                continue
+            visited.add(oid)
+            yield oid
+            for type_, oid, _ in _iter_tree_entries(oid):
                 if type_ == 'tree':
-                    yield from iter_objects_in_tree(oid)
-                else:
+                    trees.append(oid)
+                elif oid not in visited:
                     visited.add(oid)
                     yield oid
     for oid in iter_commits_and_parents(oids):
         yield oid
         commit = get_commit(oid)
-        if commit.tree not in visited:
-            yield from iter_objects_in_tree(commit.tree)
+        yield from iter_objects_in_tree(commit.tree)
 
 def get_oid(name):
     """
     get OID from reference or just its value
     """
     if name == '@': name = 'HEAD'
-    refs_to_try = [
+    refs_to_try = (
       f'{name}',
       f'refs/{name}',
       f'refs/tags/{name}',
       f'refs/heads/{name}',
-    ]
+    )
     for ref in refs_to_try:
-      if data.get_ref(ref, deref=False).value:
-          return data.get_ref(ref).value
-    is_hex = all(c in string.hexdigits for c in name)
-    if len(name) == 40 and is_hex:
-        return name
-    else:
-        raise ValueError(f'Unknown name {name}')
+      value = data.get_ref(ref, deref=False)
+      if value.value:
+          # only symbolic refs need a second lookup
+          return data.get_ref(ref).value if value.symbolic else value.value
+    if len(name) == 40:
+        try:
+            # fromhex skips spaces, so check it decoded every char
+            if len(bytes.fromhex(name)) == 20:
+                return name
+        except ValueError:
+            pass
+    raise ValueError(f'Unknown name {name}')
 
 def add(filenames):
-    def add_file(filename):
-        filename = os.path.relpath(filename)
-        with open(filename, 'rb') as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
-    
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                path = os.path.relpath(f'{root}/{filename}')
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
+    # gather every file first so that a large import is
+    # hashed as one batch across the process pool
+    paths = []
+    for name in filenames:
+        if os.path.isfile(name):
+            paths.append(os.path.relpath(name))
+        elif os.path.isdir(name):
+            paths.extend(_collect_blob_paths(name))
 
     with data.get_index() as index:
-        for name in filenames:
-            if os.path.isfile(name):
-                add_file(name)
-            elif os.path.isdir(name):
-                add_directory(name)
+        index.update(_hash_files(paths))
 
 def is_ignored(path):
-    return '.ugit' in path.split('/')
+    return '/.ugit/' in f'/{path}/'
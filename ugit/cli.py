@@ -10,7 +10,7 @@ from . import diff
 from . import remote
 
 def main():
-    with data.change_git_dir('.'):
+    with data.change_git_dir('.'), data.ref_cache():
         args = parse_args()
         args.func(args)
 
@@ -108,8 +108,7 @@ def init(args):
     print (f'Initialized empty ugit repository in {os.getcwd()}/{data.GIT_DIR}')
 
 def hash_object(args):
-    with open(args.file, 'rb') as f:
-        print(data.hash_object(f.read()))
+    print(data.hash_object_stream(args.file))
 
 def cat_file(args):
     sys.stdout.flush()
@@ -146,8 +145,8 @@ def show(args):
     if commit.parents:
         parent_tree = base.get_commit(commit.parents[0]).tree
     _print_commit(args.oid, commit)
-    result = diff.diff_trees(base.get_tree(parent_tree),
-                             base.get_tree(commit.tree))
+    result = diff.diff_entries(base.compare_tree_oids(parent_tree,
+                                                      commit.tree))
     print(result)
 
 def _diff(args):
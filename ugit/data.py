@@ -2,8 +2,10 @@ import hashlib
 import json
 import os
 import shutil
+import tempfile
+import threading
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 
 GIT_DIR = None
@@ -25,6 +27,23 @@ def init():
 
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 
+# raw ref values by path, only kept inside `ref_cache`
+_ref_cache = None
+
+@contextmanager
+def ref_cache():
+    """
+    remember the refs read while inside the block. Only
+    ugit itself may change them meanwhile, which it does
+    through `update_ref` and `delete_ref`
+    """
+    global _ref_cache
+    _ref_cache = {}
+    try:
+        yield
+    finally:
+        _ref_cache = None
+
 def update_ref(ref, value, deref=True):
     """
     update reference file OID
@@ -38,12 +57,15 @@ def update_ref(ref, value, deref=True):
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
     with open(ref_path, 'w') as f:
         f.write(value)
+    if _ref_cache is not None:
+        _ref_cache[ref_path] = value
 
 def get_ref(ref, deref=True):
     """
     get reference file OID
     """
-    return _get_ref_internal(ref, deref)[1]
+    _, symbolic, value = _get_ref_internal(ref, deref)
+    return RefValue(symbolic=symbolic, value=value)
 
 def delete_ref(ref, deref=True):
     """
@@ -51,24 +73,60 @@ def delete_ref(ref, deref=True):
     """
     ref = _get_ref_internal(ref, deref)[0]
     os.remove(f'{GIT_DIR}/{ref}')
+    if _ref_cache is not None:
+        _ref_cache.pop(f'{GIT_DIR}/{ref}', None)
 
-def _get_ref_internal(ref, deref):
+def _read_ref(ref):
     """
-    a helper function which returns the path and the value
-    of the last ref pointed by a symbolic ref
+    read the raw content of a ref file, None if there is none
     """
     ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    if _ref_cache is not None and ref_path in _ref_cache:
+        return _ref_cache[ref_path]
+    try:
+        with open(ref_path, 'rb', buffering=0) as f:
+            value = f.read().decode().strip()
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        value = None
+    if _ref_cache is not None:
+        _ref_cache[ref_path] = value
+    return value
+
+def _get_ref_internal(ref, deref, values=None):
+    """
+    a helper function which returns the path, whether it is
+    symbolic and the value of the last ref pointed by a
+    symbolic ref, as a plain tuple. Raw values already read
+    are looked up in `values` when given
+    """
+    if values is None:
+        value = _read_ref(ref)
+    else:
+        if ref not in values:
+            values[ref] = _read_ref(ref)
+        value = values[ref]
     symbolic = bool (value) and value.startswith ('ref:')
     if symbolic:
         value = value.split(':', 1)[1].strip()
         if deref:
-            return _get_ref_internal(value, deref=True)
-    return ref, RefValue(symbolic=symbolic, value=value)
+            return _get_ref_internal(value, True, values)
+    return ref, symbolic, value
 
+def _iter_ref_names(refname):
+    """
+    recursively list the ref files under `refname`
+    """
+    try:
+        it = os.scandir(f'{GIT_DIR}/{refname}')
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            name = f'{refname}/{entry.name}'
+            if entry.is_dir():
+                yield from _iter_ref_names(name)
+            elif entry.is_file():
+                yield name
 
 def iter_refs(prefix='', deref=True):
     """
@@ -76,16 +134,19 @@ def iter_refs(prefix='', deref=True):
     from the ugit directory and everything under .ugit/refs
     """
     refs = ['HEAD', 'MERGE_HEAD']
-    for root, _ , filenames in os.walk(f'{GIT_DIR}/refs'):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f'{root}/{name}' for name in filenames)
+    # only walk the part of refs/ the prefix can match
+    root = os.path.dirname(prefix) if prefix.startswith('refs/') else 'refs'
+    refs.extend(_iter_ref_names(root))
 
+    # each ref file is read once, symbolic refs are then
+    # resolved against the values already read
+    values = {}
     for refname in refs:
         if not refname.startswith(prefix):
             continue
-        ref = get_ref(refname, deref=deref)
-        if ref.value:
-            yield refname, ref
+        _, symbolic, value = _get_ref_internal(refname, deref, values)
+        if value:
+            yield refname, RefValue(symbolic=symbolic, value=value)
 
 @contextmanager
 def get_index():
@@ -100,24 +161,172 @@ def get_index():
     with open(f'{GIT_DIR}/index', 'w') as f:
         json.dump(index, f)
 
+def _sha1(data=b''):
+    # hashlib is backed by OpenSSL, which already picks the
+    # SHA-NI / ARMv8 SHA-1 instructions at runtime. Object IDs
+    # are not a security boundary, which lets FIPS builds of
+    # OpenSSL use their fast SHA-1 path too
+    return hashlib.sha1(data, usedforsecurity=False)
+
+_HEADERS = {
+    'blob': b'blob\x00',
+    'tree': b'tree\x00',
+    'commit': b'commit\x00',
+}
+
+def _header(type_):
+    header = _HEADERS.get(type_)
+    if header is None:
+        header = type_.encode() + b'\x00'
+    return header
+
+@contextmanager
+def _temp_object(objects_dir):
+    '''
+    give a temporary path in `objects_dir`. Objects are written
+    there first and then moved onto their OID, so a partial
+    object never shows up under its final name
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir)
+    os.close(fd)
+    try:
+        yield tmp_path
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+def _store_object(tmp_path, path):
+    # mkstemp creates the file as 0600, make it readable for
+    # everyone like git does, objects are never modified
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, path)
+    _written.add(path)
+
+# paths of the objects this process has already stored
+_written = set()
+
+def _needs_write(path, size):
+    # objects are immutable and only ever appear under their
+    # name once fully written, so one already on disk with the
+    # right size is identical to the one we are about to write.
+    # The size check still repairs objects damaged from outside
+    if path in _written:
+        return False
+    try:
+        if os.lstat(path).st_size == size:
+            _written.add(path)
+            return False
+    except FileNotFoundError:
+        pass
+    return True
+
+def compute_oid(data, type_ = 'blob'):
+    '''
+    compute object ID without building the full object
+    '''
+    h = _sha1 (_header(type_))
+    h.update (data)
+    return h.hexdigest ()
+
+def ensure_written(oid, data, type_ = 'blob'):
+    '''
+    store the object unless it is already there
+    '''
+    path = f'{GIT_DIR}/objects/{oid}'
+    header = _header(type_)
+    if not _needs_write(path, len(header) + len(data)):
+        return
+    with _temp_object(f'{GIT_DIR}/objects') as tmp_path:
+        with open(tmp_path, 'wb') as out:
+            out.write(header)
+            out.write(data)
+        _store_object(tmp_path, path)
+
 def hash_object(data, type_ = 'blob'):
     '''
     compute object ID and optionally create a blob from file
     '''
-    obj = type_.encode () + b'\x00' + data
-    oid = hashlib.sha1 (obj).hexdigest ()
-    with open(f'{GIT_DIR}/objects/{oid}', 'wb') as out:
-        out.write(obj)
+    oid = compute_oid(data, type_)
+    ensure_written(oid, data, type_)
+    return oid
+
+# read files in pieces this large when hashing them
+_CHUNK_SIZE = 64 * 1024
+
+def compute_file_oid(path, type_ = 'blob'):
+    '''
+    compute object ID of the file at `path` without storing it
+    '''
+    header = _header(type_)
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # python 3.11+, hashes the whole file in C
+            return hashlib.file_digest(f, lambda: _sha1(header)).hexdigest()
+        h = _sha1(header)
+        while chunk := f.read(_CHUNK_SIZE):
+            h.update(chunk)
+        return h.hexdigest()
+
+def hash_object_stream(path, type_ = 'blob'):
+    '''
+    like `hash_object`, but read the file at `path` chunk by
+    chunk so it is never held in memory as a whole. The file
+    is only copied when its object is missing, and is hashed
+    again while copied, so the stored object always matches
+    its OID even if the file changes meanwhile
+    '''
+    header = _header(type_)
+    oid = compute_file_oid(path, type_)
+    if not _needs_write(f'{GIT_DIR}/objects/{oid}',
+                        len(header) + os.path.getsize(path)):
+        return oid
+    h = _sha1(header)
+    with _temp_object(f'{GIT_DIR}/objects') as tmp_path:
+        with open(path, 'rb') as f, open(tmp_path, 'wb') as out:
+            out.write(header)
+            while chunk := f.read(_CHUNK_SIZE):
+                h.update(chunk)
+                out.write(chunk)
+        oid = h.hexdigest()
+        obj_path = f'{GIT_DIR}/objects/{oid}'
+        if _needs_write(obj_path, os.path.getsize(tmp_path)):
+            _store_object(tmp_path, obj_path)
     return oid
 
+# recently read objects, bounded by the total size of their
+# content. Objects never change, so entries are never stale
+_OBJECT_CACHE_LIMIT = 64 * 1024 * 1024
+_object_cache = OrderedDict()
+_object_cache_size = 0
+_object_cache_lock = threading.Lock()
+
+def _get_object_raw(oid):
+    global _object_cache_size
+    with _object_cache_lock:
+        if oid in _object_cache:
+            _object_cache.move_to_end(oid)
+            return _object_cache[oid]
+
+    with open (f'{GIT_DIR}/objects/{oid}', 'rb') as f:
+        obj = f.read()
+    type_, _, content = obj.partition(b'\x00')
+    obj = type_.decode(), content
+
+    if len(content) <= _OBJECT_CACHE_LIMIT:
+        with _object_cache_lock:
+            if oid not in _object_cache:
+                _object_cache[oid] = obj
+                _object_cache_size += len(content)
+            while _object_cache_size > _OBJECT_CACHE_LIMIT:
+                _, (_, evicted) = _object_cache.popitem(last=False)
+                _object_cache_size -= len(evicted)
+    return obj
+
 def get_object (oid, expected = None):
     """
     provide content or type information for repository objects
     """
-    with open (f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read()
-    type_, _, content = obj.partition(b'\x00')
-    type_ = type_.decode()
+    type_, content = _get_object_raw(oid)
 
     if expected is not None and type_ != expected:
         raise ValueError(f'Expected {expected}, got {type_}')
@@ -126,14 +335,21 @@ def get_object (oid, expected = None):
 def object_exists(oid):
     return os.path.isfile(f'{GIT_DIR}/objects/{oid}')
 
-def fetch_object_if_missing(oid):
+def _copy_object(src, dst):
+    # copyfile copies in the kernel (sendfile on Linux), the
+    # mode is set when the object is stored
+    with _temp_object(os.path.dirname(dst)) as tmp_path:
+        shutil.copyfile(src, tmp_path)
+        _store_object(tmp_path, dst)
+
+def fetch_object_if_missing(oid, remote_git_dir):
     if object_exists(oid):
         return
     remote_git_dir += '/.ugit'
-    shutil.copy(f'{remote_git_dir}/objects/{oid}',
-                f'{GIT_DIR}/objects/{oid}')
+    _copy_object(f'{remote_git_dir}/objects/{oid}',
+                 f'{GIT_DIR}/objects/{oid}')
 
 def push_object(oid, remote_git_dir):
     remote_git_dir += '/.ugit'
-    shutil.copy(f'{GIT_DIR}/objects/{oid}',
-                f'{remote_git_dir}/objects/{oid}')
+    _copy_object(f'{GIT_DIR}/objects/{oid}',
+                 f'{remote_git_dir}/objects/{oid}')
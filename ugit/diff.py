@@ -1,6 +1,10 @@
+import difflib
+import io
+import os
 import subprocess
+import threading
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile as Temp
 
 from . import data
@@ -10,13 +14,19 @@ def compare_trees(*trees):
     take a list of trees and will return them
     grouped by filename
     """
-    entries = defaultdict(lambda: [None] * len(trees))
+    entries = {}
     for i, tree in enumerate(trees):
         for path, oid in tree.items():
-            entries[path][i] = oid
+            entry = entries.get(path)
+            if entry is None:
+                entry = entries[path] = [None] * len(trees)
+            entry[i] = oid
     for path, oids in entries.items():
         yield(path, *oids)
 
+# indexed by (o_from is None) << 1 | (o_to is None)
+_ACTIONS = ('modified', 'deleted', 'new file', None)
+
 def iter_changed_files(t_from, t_to):
     """
     take two trees and output all changed paths along with
@@ -24,37 +34,56 @@ def iter_changed_files(t_from, t_to):
     """
     for path, o_from, o_to in compare_trees(t_from, t_to):
       if o_from != o_to:
-          action =('new file' if not o_from else
-                  'deleted' if not o_to else
-                  'modified')
-          yield path, action
+          yield path, _ACTIONS[(o_from is None) << 1 | (o_to is None)]
 
 def diff_trees(t_from, t_to):
     """
     takes two trees and compares them
     """
-    output = b''
-    for path, o_from, o_to in compare_trees(t_from, t_to):
+    return diff_entries(compare_trees(t_from, t_to))
+
+def diff_entries(entries):
+    """
+    take (path, o_from, o_to) entries, as returned by
+    `compare_trees` or `base.compare_tree_oids`, and
+    diff the ones which changed
+    """
+    parts = []
+    for path, o_from, o_to in entries:
         if o_from != o_to:
-            output += diff_blobs(o_from, o_to, path)
-    return output
+            parts.append(diff_blobs(o_from, o_to, path))
+    return b''.join(parts)
 
 def diff_blobs(o_from, o_to, path='blob'):
     """
-    take two blo OID and compare
-    """
-    with Temp() as f_from, Temp() as f_to:
-        for oid, f in ((o_from, f_from), (o_to, f_to)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-        with subprocess.Popen(
-            ['diff', '--unified', '--show-c-function',
-             '--label', f'a/{path}', f_from.name,
-             '--label', f'b/{path}', f_to.name],
-            stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate ()
-        return output
+    take two blob OIDs and compare them in-process,
+    producing the same unified format as `diff`
+    """
+    blobs = [data.get_object(oid) if oid else b'' for oid in (o_from, o_to)]
+    if any(b'\x00' in blob for blob in blobs):
+        return f'Binary files a/{path} and b/{path} differ\n'.encode()
+    a_lines, b_lines = (io.BytesIO(blob).readlines() for blob in blobs)
+    header = [f'--- a/{path}\n'.encode(), f'+++ b/{path}\n'.encode()]
+    if not a_lines and not b_lines:
+        return b''
+    elif not a_lines:
+        # a whole file added or removed is a single hunk,
+        # no need to search for matching lines
+        lines = [*header, f'@@ -0,0 +{_hunk_range(b_lines)} @@\n'.encode(),
+                 *(b'+' + line for line in b_lines)]
+    elif not b_lines:
+        lines = [*header, f'@@ -{_hunk_range(a_lines)} +0,0 @@\n'.encode(),
+                 *(b'-' + line for line in a_lines)]
+    else:
+        lines = difflib.diff_bytes(difflib.unified_diff, a_lines, b_lines,
+                                   fromfile=f'a/{path}'.encode(),
+                                   tofile=f'b/{path}'.encode())
+    return b''.join(line if line.endswith(b'\n') else
+                    line + b'\n\\ No newline at end of file\n'
+                    for line in lines)
+
+def _hunk_range(lines):
+    return '1' if len(lines) == 1 else f'1,{len(lines)}'
 
 def merge_trees(t_base, t_HEAD, t_other):
     """
@@ -62,26 +91,47 @@ def merge_trees(t_base, t_HEAD, t_other):
     merge each two files in the trees, output one
     merged tree
     """
-    tree = {}
-    for path, o_base, o_HEAD, o_other in compare_trees(t_base ,t_HEAD, t_other):
-        tree[path] = merge_blobs(o_base, o_HEAD, o_other)
+    return merge_entries({}, compare_trees(t_base, t_HEAD, t_other))
+
+def merge_entries(tree, entries):
+    """
+    take (path, o_base, o_HEAD, o_other) entries, as returned
+    by `compare_trees` or `base.compare_tree_oids`, merge
+    each of them and store the result in `tree`
+    """
+    entries = list(entries)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        merged = executor.map(lambda entry: merge_blobs(*entry[1:]), entries)
+        for (path, *_), content in zip(entries, merged):
+            tree[path] = data.hash_object(content)
     return tree
 
+# each thread keeps its own temporary files for `merge_blobs`,
+# they are closed and removed when the thread goes away
+_temp_files = threading.local()
+
+def _get_temp_files():
+    if not hasattr(_temp_files, 'files'):
+        _temp_files.files = (Temp(), Temp(), Temp())
+    return _temp_files.files
+
 def merge_blobs(o_base, o_HEAD, o_other):
     """
     get two OIDs and return their merged content
     """
-    with Temp() as f_base, Temp() as f_HEAD, Temp() as f_other:
-        for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-        with subprocess.Popen (
-            ['diff3', '-m',
-             '-L', 'HEAD', f_HEAD.name,
-             '-L', 'BASE', f_base.name,
-             '-L', 'MERGE_HEAD', f_other.name,
-            ], stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate ()
+    f_base, f_HEAD, f_other = _get_temp_files()
+    for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
+        f.seek(0)
+        f.truncate()
+        if oid:
+            f.write(data.get_object(oid))
+        f.flush()
+    with subprocess.Popen (
+        ['diff3', '-m',
+         '-L', 'HEAD', f_HEAD.name,
+         '-L', 'BASE', f_base.name,
+         '-L', 'MERGE_HEAD', f_other.name,
+        ], stdout=subprocess.PIPE) as proc:
+        output, _ = proc.communicate ()
 
-        return output
\ No newline at end of file
+    return output
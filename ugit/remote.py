@@ -1,19 +1,29 @@
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 from . import data
 from . import base
 
 REMOTE_REFS_BASE = 'refs/heads/'
 LOCAL_REFS_BASE = 'refs/remote/'
 
+# copying objects is I/O bound, so use plenty of threads
+_TRANSFER_WORKERS = 32
+
 def fetch(remote_path):
     """
     use `_get_remote_refs` to fetch
     """
     refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
 
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+    # list the objects on the remote side, where they all
+    # exist, so the copies can then run concurrently
+    with data.change_git_dir(remote_path):
+        oids = list(base.iter_objects_in_commits(refs.values()))
+    with ThreadPoolExecutor(max_workers=_TRANSFER_WORKERS) as executor:
+        list(executor.map(
+            lambda oid: data.fetch_object_if_missing(oid, remote_path), oids))
 
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
@@ -27,15 +37,14 @@ def push(remote_path, refname):
     remote_refs = _get_remote_refs(remote_path)
     local_ref = data.get_ref(refname).value
 
-    objects_to_push = base.iter_objects_in_commits({local_ref})
-
     known_remote_refs = filter(data.object_exists, remote_refs.values())
     remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
     local_objects = set(base.iter_objects_in_commits({local_ref}))
     objects_to_push = local_objects - remote_objects
 
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    with ThreadPoolExecutor(max_workers=_TRANSFER_WORKERS) as executor:
+        list(executor.map(
+            lambda oid: data.push_object(oid, remote_path), objects_to_push))
 
     with data.change_git_dir(remote_path):
         data.update_ref(refname,